@@ -1,52 +1,191 @@
-from flask import Flask, request, jsonify
-import sqlite3, datetime, uuid
-from collections import defaultdict
+from flask import Flask, request, jsonify, Response
+import sqlite3, datetime, uuid, threading, queue, time, atexit, os, json
+from collections import Counter
 
 app = Flask(__name__)
 
 DB = "habits.db"
+# Raw events are also appended here, one events-YYYYMMDD.jsonl file per day
+EVENT_ARCHIVE_DIR = "event_archive"
 
 # -----------------------------------
 # DATABASE HELPERS
 # -----------------------------------
-def get_db():
-    # small timeout to reduce 'database is locked' errors under concurrency
-    conn = sqlite3.connect(DB, timeout=5)
-    conn.row_factory = sqlite3.Row
-    try:
-        conn.execute("PRAGMA busy_timeout = 5000")
-    except Exception:
-        pass
+# Per-connection tuning. WAL lets readers run alongside the writer, so the
+# event and analytics endpoints no longer block each other.
+CONNECTION_PRAGMAS = (
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA foreign_keys = ON",
+)
+
+def apply_pragmas(conn):
+    for pragma in CONNECTION_PRAGMAS:
+        try:
+            conn.execute(pragma)
+        except Exception:
+            pass
     return conn
 
-def get_db_conn():
-    # For writing operations / concurrent access
-    conn = sqlite3.connect(DB, check_same_thread=False, timeout=5)
+# Prepared statements are cached per connection, keyed by SQL text; leave
+# room for every statement the app issues.
+STATEMENT_CACHE_SIZE = 256
+
+def _open_writer():
+    # autocommit; callers that need a multi-statement transaction open one
+    conn = sqlite3.connect(DB, check_same_thread=False, isolation_level=None, timeout=5,
+                           cached_statements=STATEMENT_CACHE_SIZE)
     conn.row_factory = sqlite3.Row
-    try:
-        conn.execute("PRAGMA busy_timeout = 5000")
-    except Exception:
-        pass
+    return apply_pragmas(conn)
+
+# SQLite allows a single writer at a time, so every write goes through one
+# long-lived connection serialized by writer_lock.
+_WRITER = _open_writer()
+writer_lock = threading.Lock()
+
+# Readers are cheap under WAL: keep one read-only connection per thread.
+_readers = threading.local()
+
+def get_db():
+    """Return this thread's read-only connection (opened on first use)."""
+    conn = getattr(_readers, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect("file:%s?mode=ro" % DB, uri=True, timeout=5,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        conn.row_factory = sqlite3.Row
+        _readers.conn = conn = apply_pragmas(conn)
     return conn
 
+def get_db_conn():
+    """Return the shared writer connection. Hold writer_lock while using it."""
+    return _WRITER
+
+def raw_json(body, status=200):
+    """Respond with a JSON string SQLite already built, skipping jsonify."""
+    return Response(body, status=status, mimetype="application/json")
+
+# (UTC day number, "YYYY-MM-DD" of that day, "YYYY-MM-DD" of the next day).
+# Replaced as a whole tuple so request threads never see a half-updated entry.
+_today_cache = (None, "", "")
+
+def utc_day_range():
+    """Return today's UTC date and tomorrow's as ISO strings, reformatting
+    only when the day number changes rather than on every call."""
+    global _today_cache
+    day_no = int(time.time() // 86400)
+    cached_day, today, tomorrow = _today_cache
+    if cached_day != day_no:
+        start = datetime.date(1970, 1, 1) + datetime.timedelta(days=day_no)
+        today, tomorrow = start.isoformat(), (start + datetime.timedelta(days=1)).isoformat()
+        _today_cache = (day_no, today, tomorrow)
+    return today, tomorrow
+
+def archive_events(records):
+    """Append event dicts to EVENT_ARCHIVE_DIR/events-YYYYMMDD.jsonl, filed by
+    the day of each record's "timestamp"."""
+    lines_by_day = {}
+    for record in records:
+        lines_by_day.setdefault(record["timestamp"][:10], []).append(json.dumps(record) + "\n")
+    os.makedirs(EVENT_ARCHIVE_DIR, exist_ok=True)
+    for day, lines in lines_by_day.items():
+        path = os.path.join(EVENT_ARCHIVE_DIR, "events-%s.jsonl" % day.replace("-", ""))
+        # Every gunicorn worker appends to the same files. One write() on an
+        # O_APPEND fd lands as a single run at the end of the file, so
+        # concurrent chunks never interleave mid-line.
+        data = memoryview("".join(lines).encode("utf-8"))
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
 
-def row_get(row, key):
-    """Safely get a value from a DB row or a dict-like row.
-    sqlite3.Row does not implement .get(), so handle both types.
-    """
-    if isinstance(row, dict):
-        return row.get(key)
-    try:
-        return row[key]
-    except Exception:
-        return None
+
+# -----------------------------------
+# HOT-PATH SQL
+# -----------------------------------
+# Shared constants keep the SQL text identical at every call site, so each
+# statement is parsed once per connection and then reused from the cache.
+SQL_INSERT_LOG = "INSERT INTO habit_logs (user_uuid, habit_id, event_type, timestamp, source) VALUES (?,?,?,?,?)"
+
+SQL_INSERT_HABIT = "INSERT INTO habits (name, description) VALUES (?, ?) ON CONFLICT DO NOTHING RETURNING id"
+
+SQL_SELECT_LAST_EVENT = """
+    SELECT id, habit_id, event_type, timestamp FROM habit_logs
+    WHERE habit_id = ? AND timestamp >= ? ORDER BY timestamp DESC, id DESC LIMIT 1
+"""
+
+SQL_SELECT_STATUS_TODAY = """
+    SELECT event_type FROM habit_logs
+    WHERE habit_id = ? AND timestamp >= ? AND timestamp < ?
+    ORDER BY timestamp DESC, id DESC LIMIT 1
+"""
+
+# {habit id: status} for every habit, from its latest event in [?, ?); one
+# index seek per habit, with the JSON built by SQLite
+SQL_SELECT_LATEST_TODAY = """
+    SELECT json_group_object(CAST(h.id AS TEXT), json_object(
+        'status', COALESCE(l.event_type, 'none'),
+        'last_time', l.timestamp,
+        'can_edit', json('true')
+    ))
+    FROM habits h
+    LEFT JOIN habit_logs l ON l.id = (
+        SELECT id FROM habit_logs
+        WHERE habit_id = h.id AND timestamp >= ?1 AND timestamp < ?2
+        ORDER BY timestamp DESC, id DESC LIMIT 1
+    )
+"""
+
+
+# -----------------------------------
+# ANALYTICS CACHE
+# -----------------------------------
+ANALYTICS_TTL = 30  # seconds
+
+# Last /analytics payload. "gen" is bumped by every write so a summary that
+# was being built while data changed is not stored.
+_analytics_cache = {"ts": 0, "gen": 0, "payload": None}
+_analytics_lock = threading.Lock()
+
+def invalidate_analytics():
+    with _analytics_lock:
+        _analytics_cache["gen"] += 1
+        _analytics_cache["payload"] = None
 
 
 # -----------------------------------
 # INITIAL TABLES
 # -----------------------------------
+# Bump whenever init_db() / ensure_tables() change. Startup only runs them when
+# the version recorded in the DB is older.
+SCHEMA_VERSION = 5
+
+# habit_logs only keeps the rows the status, undo and 30-day analytics queries
+# read; older events live on in the JSONL archive and in daily_agg.
+LOG_RETENTION_DAYS = 35
+PRUNE_BATCH_SIZE = 1000  # rows per DELETE, so the write lock is released often
+
+# habit_rolling_30d holds each habit's completions over the last
+# ROLLING_WINDOW_DAYS days (today included), for the analytics top habits
+ROLLING_WINDOW_DAYS = 30
+SQL_REFRESH_ROLLING = (
+    "DELETE FROM habit_rolling_30d",
+    """
+    INSERT INTO habit_rolling_30d (habit_id, completions)
+    SELECT habit_id, SUM(completions) FROM daily_agg
+    WHERE day >= date('now', '-%d days')
+    GROUP BY habit_id
+    HAVING SUM(completions) > 0
+    """ % (ROLLING_WINDOW_DAYS - 1),
+)
+
 def init_db():
-    conn = get_db()
+    conn = get_db_conn()
     conn.execute("""
         CREATE TABLE IF NOT EXISTS habits (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -54,10 +193,10 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     """)
-    conn.commit()
     # ensure unique index on habit name to prevent duplicates
     conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_habits_name_unique ON habits(name)")
-    conn.commit()
+    # names are unique case-insensitively too; see ensure_name_ci_index()
+    create_name_ci_index(conn)
     # Ensure new optional columns exist: description, active
     cur = conn.cursor()
     cur.execute("PRAGMA table_info(habits)")
@@ -68,7 +207,18 @@ def init_db():
         conn.execute("ALTER TABLE habits ADD COLUMN active INTEGER DEFAULT 1")
     if "archived_at" not in existing:
         conn.execute("ALTER TABLE habits ADD COLUMN archived_at TEXT DEFAULT NULL")
-    conn.commit()
+    # GET /habits?active=... filters on active and sorts by created_at
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_habits_active ON habits(active, created_at DESC)")
+
+def create_name_ci_index(conn):
+    """Create idx_habits_name_ci, returning False if existing names that
+    differ only by case (allowed by older versions) prevent it."""
+    try:
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_habits_name_ci ON habits(lower(name))")
+        return True
+    except sqlite3.IntegrityError:
+        app.logger.warning("habits has names differing only by case; idx_habits_name_ci not created")
+        return False
 
 def ensure_tables():
     conn = get_db_conn()
@@ -98,12 +248,341 @@ def ensure_tables():
         )
     """)
 
-    conn.commit()
-    conn.close()
+    # status lookups and analytics filter habit_logs by habit / event type + time
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_logs_habit_ts ON habit_logs(habit_id, timestamp DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_logs_type_ts ON habit_logs(event_type, timestamp)")
+    # daily_agg(habit_id, day) is already covered by its UNIQUE constraint
+
+    # Rolling completion counters; refresh_rolling_counts() recomputes them
+    # daily so expired days drop out
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS habit_rolling_30d (
+            habit_id INTEGER PRIMARY KEY,
+            completions INTEGER DEFAULT 0
+        )
+    """)
+    for sql in SQL_REFRESH_ROLLING:
+        cur.execute(sql)
+
+    # Keep daily_agg and habit_rolling_30d in step with habit_logs inside
+    # SQLite, so writers only insert / delete log rows
+    cur.execute("DROP TRIGGER IF EXISTS trg_log_ins")
+    cur.execute("""
+        CREATE TRIGGER trg_log_ins AFTER INSERT ON habit_logs
+        BEGIN
+            INSERT INTO daily_agg (habit_id, day, completions, skips)
+            VALUES (NEW.habit_id, substr(NEW.timestamp, 1, 10),
+                    NEW.event_type = 'complete', NEW.event_type = 'skip')
+            ON CONFLICT(habit_id, day) DO UPDATE SET
+                completions = completions + excluded.completions,
+                skips = skips + excluded.skips;
+            INSERT INTO habit_rolling_30d (habit_id, completions)
+            SELECT NEW.habit_id, 1 WHERE NEW.event_type = 'complete'
+            ON CONFLICT(habit_id) DO UPDATE SET completions = completions + 1;
+        END
+    """)
+    # Only deletes inside the retention window (undo) touch the aggregates;
+    # pruning older rows leaves them intact. prune_logs() computes its cutoff
+    # once before deleting, and date('now', ...) here can only move later, so
+    # every row it prunes stays outside this window.
+    cur.execute("DROP TRIGGER IF EXISTS trg_log_del")
+    cur.execute("""
+        CREATE TRIGGER trg_log_del AFTER DELETE ON habit_logs
+        WHEN OLD.timestamp >= date('now', '-%d days')
+        BEGIN
+            UPDATE daily_agg
+            SET completions = MAX(completions - (OLD.event_type = 'complete'), 0),
+                skips = MAX(skips - (OLD.event_type = 'skip'), 0)
+            WHERE habit_id = OLD.habit_id AND day = substr(OLD.timestamp, 1, 10);
+            UPDATE habit_rolling_30d
+            SET completions = MAX(completions - 1, 0)
+            WHERE habit_id = OLD.habit_id AND OLD.event_type = 'complete'
+              AND OLD.timestamp >= date('now', '-%d days');
+        END
+    """ % (LOG_RETENTION_DAYS, ROLLING_WINDOW_DAYS - 1))
+
+def schema_version(conn):
+    try:
+        return conn.execute("SELECT MAX(v) FROM _schema_version").fetchone()[0] or 0
+    except sqlite3.OperationalError:
+        # no _schema_version table yet
+        return 0
+
+def migrate():
+    """Bring the schema up to SCHEMA_VERSION. Once it is, startup is a single
+    SELECT; several workers booting at once serialize on BEGIN IMMEDIATE and
+    only the first one runs the DDL."""
+    conn = get_db_conn()
+    if schema_version(conn) >= SCHEMA_VERSION:
+        return
+    # journal_mode is persistent (recorded in the DB header) and cannot be
+    # changed inside a transaction
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version = schema_version(conn)
+        if version < SCHEMA_VERSION:
+            init_db()
+            ensure_tables()
+            if version < 3:
+                # events logged before the JSONL archive existed still need
+                # copying; backfill_archive() does it after this commit
+                conn.execute("CREATE TABLE _archive_backfill (last_id INTEGER NOT NULL)")
+                conn.execute("INSERT INTO _archive_backfill (last_id) VALUES (0)")
+            conn.execute("CREATE TABLE IF NOT EXISTS _schema_version (v INTEGER PRIMARY KEY)")
+            conn.execute("INSERT OR IGNORE INTO _schema_version (v) VALUES (?)", (SCHEMA_VERSION,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+ARCHIVE_BACKFILL_BATCH = 1000
+
+def archive_backfill_pending(conn):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = '_archive_backfill'"
+    ).fetchone() is not None
+
+def backfill_archive():
+    """Copy habit_logs rows queued by migrate() into the JSONL archive,
+    ARCHIVE_BACKFILL_BATCH rows per transaction so no worker holds the write
+    lock for long. Progress lives in _archive_backfill, so workers booting
+    together share the work and an interrupted run resumes where it stopped.
+    prune_logs() waits until the table is gone."""
+    conn = get_db_conn()
+    while True:
+        with writer_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if not archive_backfill_pending(conn):
+                    conn.rollback()
+                    return
+                last_id = conn.execute("SELECT last_id FROM _archive_backfill").fetchone()[0]
+                rows = conn.execute(
+                    "SELECT id, user_uuid, habit_id, event_type, timestamp, source FROM habit_logs"
+                    " WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, ARCHIVE_BACKFILL_BATCH)
+                ).fetchall()
+                if rows:
+                    archive_events([
+                        {k: r[k] for k in ("user_uuid", "habit_id", "event_type", "timestamp", "source")}
+                        for r in rows
+                    ])
+                    conn.execute("UPDATE _archive_backfill SET last_id = ?", (rows[-1]["id"],))
+                else:
+                    conn.execute("DROP TABLE _archive_backfill")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+def ensure_name_ci_index():
+    """True once idx_habits_name_ci exists. Retried on every startup, so the
+    index appears as soon as case-variant duplicates have been renamed."""
+    conn = get_db_conn()
+    if conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_habits_name_ci'"
+    ).fetchone():
+        return True
+    with writer_lock:
+        return create_name_ci_index(conn)
+
+
+migrate()
+backfill_archive()
+# create_habit checks lower(name) by hand while this is False
+NAME_CI_INDEXED = ensure_name_ci_index()
+
+
+# -----------------------------------
+# EVENT WRITER
+# -----------------------------------
+WRITE_BATCH_SIZE = 50
+WRITE_BATCH_WAIT = 0.02  # seconds to keep collecting after the first event
+
+WRITE_RETRIES = 3
+# /events/batch commits in one transaction under writer_lock; bound how long
+# one request can hold it
+MAX_BATCH_EVENTS = 500
+UPKEEP_CHECK_INTERVAL = 60  # seconds
+
+# Items are habit_logs rows, or a threading.Event used as a flush marker.
+write_q = queue.Queue()
+
+# Write failure counts, reported by /healthz
+write_failures = Counter()
+_failures_lock = threading.Lock()
+
+def record_failure(kind, n=1):
+    with _failures_lock:
+        write_failures[kind] += n
+
+SQLITE_INT_MIN, SQLITE_INT_MAX = -2 ** 63, 2 ** 63 - 1
+
+def bindable(*values):
+    """True if every value can be bound as a habit_logs column: None, an int
+    within SQLite's 64-bit range or a string that encodes as UTF-8."""
+    for v in values:
+        if v is None:
+            continue
+        if isinstance(v, int):
+            if not SQLITE_INT_MIN <= v <= SQLITE_INT_MAX:
+                return False
+        elif isinstance(v, str):
+            try:
+                v.encode("utf-8")
+            except UnicodeEncodeError:
+                return False
+        else:
+            return False
+    return True
 
+def persist_events(rows):
+    """Insert habit_logs rows (user_uuid, habit_id, event_type, timestamp, source)
+    in one transaction; trg_log_ins folds each into daily_agg.
 
-init_db()
-ensure_tables()
+    "database is locked" (another process kept the write lock past
+    busy_timeout) is retried with backoff; any other error is raised."""
+    for attempt in range(WRITE_RETRIES):
+        try:
+            with writer_lock:
+                conn = get_db_conn()
+                cur = conn.cursor()
+                # the write lock is taken before the first statement and the
+                # whole batch costs a single fsync
+                cur.execute("BEGIN IMMEDIATE")
+                try:
+                    cur.executemany(SQL_INSERT_LOG, rows)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+            break
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) or attempt == WRITE_RETRIES - 1:
+                raise
+            record_failure("locked_retries")
+            time.sleep(0.01 * 2 ** attempt)
+    invalidate_analytics()
+
+    # the archive is a copy; a failed append must not fail the committed write
+    try:
+        archive_events([
+            {"user_uuid": u, "habit_id": h, "event_type": e, "timestamp": t, "source": s}
+            for u, h, e, t, s in rows
+        ])
+    except OSError as e:
+        record_failure("archive_errors")
+        app.logger.error("failed to archive %d events: %s", len(rows), e)
+
+def prune_logs():
+    """Drop habit_logs rows older than LOG_RETENTION_DAYS. They are already in
+    the archive, and trg_log_del leaves daily_agg alone for rows this old.
+
+    Deletes PRUNE_BATCH_SIZE rows per statement and releases writer_lock in
+    between, so the first prune of a large legacy table cannot hold the
+    database long enough for the other worker's writes to time out."""
+    conn = get_db_conn()
+    with writer_lock:
+        # rows not yet copied by backfill_archive() exist nowhere else
+        if archive_backfill_pending(conn):
+            return 0
+        cutoff = conn.execute("SELECT date('now', ?)", ("-%d days" % LOG_RETENTION_DAYS,)).fetchone()[0]
+    pruned = 0
+    while True:
+        with writer_lock:
+            # ids grow with server-assigned timestamps, so in id order the
+            # old rows come first and each chunk stops scanning early
+            cur = conn.execute(
+                "DELETE FROM habit_logs WHERE id IN"
+                " (SELECT id FROM habit_logs WHERE timestamp < ? ORDER BY id LIMIT ?)",
+                (cutoff, PRUNE_BATCH_SIZE)
+            )
+        pruned += cur.rowcount
+        if cur.rowcount < PRUNE_BATCH_SIZE:
+            return pruned
+
+def refresh_rolling_counts():
+    """Recompute habit_rolling_30d from daily_agg, dropping days that have
+    left the window. Idempotent, so a missed or repeated run is harmless."""
+    with writer_lock:
+        conn = get_db_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for sql in SQL_REFRESH_ROLLING:
+                conn.execute(sql)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    invalidate_analytics()
+
+def _daily_upkeep():
+    prune_logs()
+    refresh_rolling_counts()
+
+def _event_writer():
+    # Group commit: drain up to WRITE_BATCH_SIZE events, or whatever arrives
+    # within WRITE_BATCH_WAIT of the first one, into a single transaction.
+    # Waking up every UPKEEP_CHECK_INTERVAL also runs _daily_upkeep() once
+    # per UTC day even when no events arrive.
+    upkeep_day = None
+    while True:
+        try:
+            item = write_q.get(timeout=UPKEEP_CHECK_INTERVAL)
+        except queue.Empty:
+            item = None
+        batch, waiters = [], []
+        deadline = time.monotonic() + WRITE_BATCH_WAIT
+        while item is not None:
+            if isinstance(item, threading.Event):
+                waiters.append(item)
+                break
+            batch.append(item)
+            remaining = deadline - time.monotonic()
+            if len(batch) >= WRITE_BATCH_SIZE or remaining <= 0:
+                break
+            try:
+                item = write_q.get(timeout=remaining)
+            except queue.Empty:
+                break
+        if batch:
+            try:
+                persist_events(batch)
+            except Exception as e:
+                # Anything that escapes here would kill the only writer thread,
+                # so catch it all. No traceback: under a flood of failures
+                # formatting one per batch is itself expensive.
+                record_failure("failed_batches")
+                record_failure("dropped_events", len(batch))
+                app.logger.error("failed to persist %d events to DB: %s", len(batch), e)
+        for waiter in waiters:
+            waiter.set()
+        for _ in range(len(batch) + len(waiters)):
+            write_q.task_done()
+        today = utc_day_range()[0]
+        if today != upkeep_day:
+            try:
+                _daily_upkeep()
+                upkeep_day = today
+            except Exception as e:
+                app.logger.error("daily upkeep failed: %s", e)
+
+def flush_writes(timeout=5):
+    """Block until every event queued so far has been written.
+
+    Only this worker's queue is flushed: an event POSTed to another gunicorn
+    worker may still be in that worker's write_q."""
+    # nothing queued or mid-commit: skip the round trip through the writer
+    if not write_q.unfinished_tasks:
+        return True
+    done = threading.Event()
+    write_q.put(done)
+    return done.wait(timeout)
+
+_writer_thread = threading.Thread(target=_event_writer, name="event-writer", daemon=True)
+_writer_thread.start()
+atexit.register(flush_writes)
 
 
 # -----------------------------------
@@ -121,23 +600,35 @@ def create_habit():
     if not name:
         return jsonify({"error": "Name is required"}), 400
 
-    conn = get_db()
-    cur = conn.cursor()
-
-    # check for duplicate names (case-insensitive)
-    cur.execute("SELECT id FROM habits WHERE lower(name)=?", (name.lower(),))
-    existing = cur.fetchone()
-    
-    if existing:
+    # the unique indexes reject duplicates (case-insensitive) atomically;
+    # fetchall() steps the statement to completion so it commits here
+    with writer_lock:
+        conn = get_db_conn()
+        if NAME_CI_INDEXED:
+            inserted = conn.execute(SQL_INSERT_HABIT, (name, description)).fetchall()
+        else:
+            # legacy DB without idx_habits_name_ci: check by hand, in one
+            # transaction so the other worker cannot insert in between
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if conn.execute("SELECT 1 FROM habits WHERE lower(name)=?", (name.lower(),)).fetchone():
+                    inserted = []
+                else:
+                    inserted = conn.execute(SQL_INSERT_HABIT, (name, description)).fetchall()
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    if not inserted:
+        existing = get_db().execute("SELECT id FROM habits WHERE lower(name)=?", (name.lower(),)).fetchone()
         return jsonify({
             "error": "A habit with this name already exists",
-            "existing_id": existing["id"]
+            "existing_id": existing["id"] if existing else None
         }), 409
 
-    cur.execute("INSERT INTO habits (name, description) VALUES (?, ?)", (name, description))
-    conn.commit()
-    new_id = cur.lastrowid
-    conn.close()
+    new_id = inserted[0]["id"]
+    invalidate_analytics()
 
     return jsonify({
         "id": new_id,
@@ -152,18 +643,25 @@ def create_habit():
 @app.route("/habits", methods=["GET"])
 def get_habits():
     conn = get_db()
-    # Return all habits with their active field - client will filter
-    rows = conn.execute("SELECT * FROM habits ORDER BY created_at DESC").fetchall()
-    habits = [{
-        "id": row["id"],
-        "name": row["name"],
-        "description": row_get(row, "description"),
-        "active": row_get(row, "active"),
-        "archived_at": row_get(row, "archived_at"),
-        "created_at": row["created_at"]
-    } for row in rows]
+    # All habits by default; ?active=1 / ?active=0 filters server-side
+    active = request.args.get("active")
+    where, params = "", ()
+    if active is not None:
+        try:
+            params = (1 if int(active) else 0,)
+        except ValueError:
+            return jsonify({"error": "Invalid active value"}), 400
+        where = "WHERE active = ?"
 
-    return jsonify({"habits": habits})
+    habits = conn.execute("""
+        SELECT json_group_array(json_object(
+            'id', id, 'name', name, 'description', description, 'active', active,
+            'archived_at', archived_at, 'created_at', created_at
+        ))
+        FROM (SELECT * FROM habits %s ORDER BY created_at DESC)
+    """ % where, params).fetchone()[0]
+
+    return raw_json('{"habits":%s}' % habits)
 
 
 @app.route("/habits/<int:habit_id>", methods=["GET"])
@@ -174,17 +672,10 @@ def get_habit(habit_id):
     if not row:
         return jsonify({"error": "Habit not found"}), 404
 
-    return jsonify({
-        "id": row["id"],
-        "name": row["name"],
-        "description": row_get(row, "description"),
-        "active": row_get(row, "active"),
-        "archived_at": row_get(row, "archived_at"),
-        "created_at": row["created_at"]
-    }), 200
+    return jsonify(dict(row)), 200
 
 
-# Log an event (in-memory example)
+# Log an event
 @app.route("/events", methods=["POST"])
 def log_event():
     data = request.get_json()
@@ -192,16 +683,17 @@ def log_event():
     habit_id = data.get("habit_id")
     event_type = data.get("event_type")
     source = data.get("source", "unknown")
+    user_uuid = data.get("user_uuid") or str(uuid.uuid4())
 
     if not habit_id or not event_type:
         return jsonify({"error": "Missing habit_id or event_type"}), 400
+    # queued events are committed together, so reject values SQLite cannot
+    # bind now rather than failing the whole batch later
+    if not bindable(habit_id, event_type, source, user_uuid):
+        return jsonify({"error": "Invalid event fields"}), 400
 
     timestamp = datetime.datetime.utcnow().isoformat()
 
-    # In-memory example (replace with DB later)
-    if "events" not in app.config:
-        app.config["events"] = []
-
     event_record = {
         "habit_id": habit_id,
         "event_type": event_type,
@@ -209,90 +701,105 @@ def log_event():
         "timestamp": timestamp
     }
 
-    app.config["events"].append(event_record)
+    # habit_logs is the source of truth. The event writer thread commits the
+    # row (batched with concurrent events) shortly after.
+    write_q.put((user_uuid, habit_id, event_type, timestamp, source))
 
-    # Also persist to DB so undo and status endpoints work
-    try:
-        user_uuid = data.get("user_uuid") or str(uuid.uuid4())
-        conn = get_db_conn()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO habit_logs (user_uuid, habit_id, event_type, timestamp, source) VALUES (?,?,?,?,?)",
-            (user_uuid, habit_id, event_type, timestamp, source)
-        )
-        # update daily_agg
-        day = timestamp.split("T")[0]
-        cur.execute("INSERT OR IGNORE INTO daily_agg (habit_id, day, completions, skips) VALUES (?,?,0,0)", (habit_id, day))
-        if event_type == "complete":
-            cur.execute("UPDATE daily_agg SET completions = completions + 1 WHERE habit_id = ? AND day = ?", (habit_id, day))
-        elif event_type == "skip":
-            cur.execute("UPDATE daily_agg SET skips = skips + 1 WHERE habit_id = ? AND day = ?", (habit_id, day))
-        conn.commit()
-        conn.close()
-    except Exception:
-        app.logger.exception("failed to persist event to DB")
+    return jsonify({"status": "event_logged", "event": event_record}), 202
 
-    return jsonify({"status": "event_logged", "event": event_record}), 201
+
+# Log many events in one request / one transaction
+@app.route("/events/batch", methods=["POST"])
+def log_events_batch():
+    data = request.get_json()
+    if not isinstance(data, list) or not data:
+        return jsonify({"error": "Expected a non-empty list of events"}), 400
+    if len(data) > MAX_BATCH_EVENTS:
+        return jsonify({"error": "Too many events", "max": MAX_BATCH_EVENTS}), 400
+
+    timestamp = datetime.datetime.utcnow().isoformat()
+
+    rows = []
+    for i, item in enumerate(data):
+        item = item if isinstance(item, dict) else {}
+        habit_id = item.get("habit_id")
+        event_type = item.get("event_type")
+        user_uuid = item.get("user_uuid") or str(uuid.uuid4())
+        source = item.get("source", "unknown")
+        if not habit_id or not event_type:
+            return jsonify({"error": "Missing habit_id or event_type", "index": i}), 400
+        if not bindable(habit_id, event_type, source, user_uuid):
+            return jsonify({"error": "Invalid event fields", "index": i}), 400
+        rows.append((user_uuid, habit_id, event_type, timestamp, source))
+
+    persist_events(rows)
+
+    return jsonify({"status": "events_logged", "count": len(rows), "timestamp": timestamp}), 201
 
 
 @app.route("/events/undo", methods=["POST"])
 def undo_last_event():
     data = request.get_json() or {}
     habit_id = data.get("habit_id")
-    window_seconds = int(data.get("window_seconds", 60))
+    # rows older than the retention window no longer count towards daily_agg
+    window_seconds = min(int(data.get("window_seconds", 60)), LOG_RETENTION_DAYS * 86400)
 
     if not habit_id:
         return jsonify({"error":"habit_id required"}), 400
 
-    conn = get_db_conn()
-    cur = conn.cursor()
+    # make sure queued events are on disk before looking for the last one.
+    # Only this worker's queue is flushed, so an event POSTed to the other
+    # worker a moment ago may not be found yet (see README).
+    flush_writes()
 
-    cutoff = (datetime.datetime.utcnow() - datetime.timedelta(seconds=window_seconds)).isoformat()
-    # find last event for habit after cutoff
-    cur.execute("""SELECT id, event_type, timestamp FROM habit_logs
-                   WHERE habit_id = ? AND timestamp >= ? ORDER BY timestamp DESC LIMIT 1""",
-                (habit_id, cutoff))
-    row = cur.fetchone()
-    if not row:
-        return jsonify({"status":"no_recent_event"}), 404
+    with writer_lock:
+        conn = get_db_conn()
+        cur = conn.cursor()
 
-    # delete it, and decrement daily_agg counters if needed
-    event_id = row["id"]
-    event_type = row["event_type"]
-    ts = row["timestamp"]
-    day = ts.split("T")[0]
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            cutoff = (datetime.datetime.utcnow() - datetime.timedelta(seconds=window_seconds)).isoformat()
+            # find last event for habit after cutoff
+            cur.execute(SQL_SELECT_LAST_EVENT, (habit_id, cutoff))
+            row = cur.fetchone()
+            if not row:
+                conn.rollback()
+                return jsonify({"status":"no_recent_event"}), 404
+
+            # delete it; trg_log_del decrements the daily_agg counters
+            cur.execute("DELETE FROM habit_logs WHERE id = ?", (row["id"],))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    invalidate_analytics()
 
-    cur.execute("DELETE FROM habit_logs WHERE id = ?", (event_id,))
-    if event_type == "complete":
-        cur.execute("""
-            UPDATE daily_agg
-            SET completions = CASE WHEN completions > 0 THEN completions - 1 ELSE 0 END
-            WHERE habit_id = ? AND day = ?
-        """, (habit_id, day))
-    elif event_type == "skip":
-        cur.execute("""
-            UPDATE daily_agg
-            SET skips = CASE WHEN skips > 0 THEN skips - 1 ELSE 0 END
-            WHERE habit_id = ? AND day = ?
-        """, (habit_id, day))
+    # tombstone filed next to the event it cancels
+    try:
+        archive_events([{
+            "undo": True,
+            "habit_id": row["habit_id"],
+            "event_type": row["event_type"],
+            "timestamp": row["timestamp"],
+            "undone_at": datetime.datetime.utcnow().isoformat()
+        }])
+    except OSError as e:
+        record_failure("archive_errors")
+        app.logger.error("failed to archive undo: %s", e)
 
-    conn.commit()
-    conn.close()
     return jsonify({"status":"undone"}), 200
 
 
 # Get today's status for a habit
 @app.route("/habit_status_today/<int:habit_id>", methods=["GET"])
 def get_habit_status_today(habit_id):
-    today = datetime.date.today().isoformat()
+    # /events answers before its row is committed; let a client read back its own write
+    flush_writes()
+    today, tomorrow = utc_day_range()
     conn = get_db()
 
     # Check if any event logged for this habit today
-    row = conn.execute("""
-        SELECT event_type FROM habit_logs
-        WHERE habit_id = ? AND timestamp LIKE ?
-        ORDER BY timestamp DESC LIMIT 1
-    """, (habit_id, today + "%")).fetchone()
+    row = conn.execute(SQL_SELECT_STATUS_TODAY, (habit_id, today, tomorrow)).fetchone()
 
     if not row:
         return jsonify({"status": "none"}), 200
@@ -305,7 +812,6 @@ def update_habit(habit_id):
     data = request.get_json() or {}
 
     conn = get_db()
-    cur = conn.cursor()
 
     # ensure habit exists
     existing = conn.execute("SELECT * FROM habits WHERE id = ?", (habit_id,)).fetchone()
@@ -349,148 +855,127 @@ def update_habit(habit_id):
 
     params.append(habit_id)
     sql = "UPDATE habits SET " + ", ".join(fields) + " WHERE id = ?"
-    cur.execute(sql, params)
-    conn.commit()
-    conn.close()
+    try:
+        with writer_lock:
+            get_db_conn().execute(sql, params)
+    except sqlite3.IntegrityError:
+        return jsonify({"error": "A habit with this name already exists"}), 409
+    invalidate_analytics()
 
     return jsonify({"message": "Habit updated"}), 200
 
 
 @app.route("/habits/<int:habit_id>/archive", methods=["POST"])
 def archive_habit(habit_id):
-    conn = get_db()
-    cur = conn.cursor()
     # set active = 0 and archived_at
     archived_at = datetime.datetime.utcnow().isoformat()
-    cur.execute("UPDATE habits SET active = 0, archived_at = ? WHERE id = ?", (archived_at, habit_id))
-    conn.commit()
+    with writer_lock:
+        cur = get_db_conn().execute("UPDATE habits SET active = 0, archived_at = ? WHERE id = ?", (archived_at, habit_id))
+    invalidate_analytics()
     if cur.rowcount == 0:
-        conn.close()
         return jsonify({"error": "Habit not found"}), 404
-    conn.close()
     return jsonify({"message": "Habit archived", "archived_at": archived_at}), 200
 
 
 @app.route("/habits/<int:habit_id>/unarchive", methods=["POST"])
 def unarchive_habit(habit_id):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("UPDATE habits SET active = 1, archived_at = NULL WHERE id = ?", (habit_id,))
-    conn.commit()
+    with writer_lock:
+        cur = get_db_conn().execute("UPDATE habits SET active = 1, archived_at = NULL WHERE id = ?", (habit_id,))
+    invalidate_analytics()
     if cur.rowcount == 0:
-        conn.close()
         return jsonify({"error": "Habit not found"}), 404
-    conn.close()
     return jsonify({"message": "Habit unarchived"}), 200
 
 
 @app.route("/habits/archived", methods=["GET"])
 def get_archived_habits():
     conn = get_db()
-    rows = conn.execute("SELECT * FROM habits WHERE active = 0 ORDER BY archived_at DESC").fetchall()
-    habits = [{
-        "id": row["id"],
-        "name": row["name"],
-        "description": row_get(row, "description"),
-        "archived_at": row_get(row, "archived_at"),
-        "created_at": row["created_at"]
-    } for row in rows]
-    return jsonify({"habits": habits})
+    habits = conn.execute("""
+        SELECT json_group_array(json_object(
+            'id', id, 'name', name, 'description', description,
+            'archived_at', archived_at, 'created_at', created_at
+        ))
+        FROM (SELECT * FROM habits WHERE active = 0 ORDER BY archived_at DESC)
+    """).fetchone()[0]
+    return raw_json('{"habits":%s}' % habits)
 
 
 @app.route("/habits/<int:habit_id>", methods=["DELETE"])
 def delete_habit(habit_id):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM habits WHERE id = ?", (habit_id,))
-    conn.commit()
+    with writer_lock:
+        cur = get_db_conn().execute("DELETE FROM habits WHERE id = ?", (habit_id,))
+    invalidate_analytics()
 
     if cur.rowcount == 0:
-        conn.close()
         return jsonify({"error": "Habit not found"}), 404
 
-    conn.close()
     return jsonify({"message": "Habit deleted"}), 200
 
 
 @app.route("/today_status_all", methods=["GET"])
 def today_status_all():
+    flush_writes()
     conn = get_db()
-    cur = conn.cursor()
-
-    today = datetime.datetime.utcnow().strftime("%Y-%m-%d")
 
-    # Fetch latest event PER habit for today
-    cur.execute("""
-        SELECT habit_id, event_type, MAX(timestamp) AS ts
-        FROM habit_logs
-        WHERE timestamp LIKE ?
-        GROUP BY habit_id
-    """, (today + "%",))
-
-    rows = cur.fetchall()
-
-    result = {}
-
-    for row in rows:
-        # row is sqlite3.Row
-        result[row["habit_id"]] = {
-            "status": row["event_type"],
-            "last_time": row["ts"],
-            "can_edit": True  # editable until 23:59:59
-        }
+    today, tomorrow = utc_day_range()
 
-    # If a habit has no log today → set default
-    # Fetch all habit IDs
-    hrows = conn.execute("SELECT id FROM habits").fetchall()
-    for h in hrows:
-        hid = h["id"]
-        if hid not in result:
-            result[hid] = {
-                "status": "none",
-                "last_time": None,
-                "can_edit": True
-            }
+    # Latest event PER habit for today; habits with no log today get "none".
+    # can_edit is always true: editable until 23:59:59
+    statuses = conn.execute(SQL_SELECT_LATEST_TODAY, (today, tomorrow)).fetchone()[0]
 
-    return jsonify({"statuses": result})
+    return raw_json('{"statuses":%s}' % statuses)
 
 
 # GET /analytics/summary (also available as /analytics)
 @app.route("/analytics/summary", methods=["GET"])
 @app.route("/analytics", methods=["GET"])
 def analytics_summary():
+    # dashboards poll this; serve the last summary until it expires or a write invalidates it.
+    # Flushing first means this worker's queued events have invalidated it already.
+    flush_writes()
+    with _analytics_lock:
+        cached = _analytics_cache["payload"]
+        fresh = time.monotonic() - _analytics_cache["ts"] < ANALYTICS_TTL
+        gen = _analytics_cache["gen"]
+    if cached is not None and fresh:
+        return jsonify(cached), 200
+
     try:
-        conn = get_db_conn()
+        conn = get_db()
         cur = conn.cursor()
 
-        today = datetime.date.today()
+        # event timestamps are UTC, so "today" is the UTC day
+        today_iso, tomorrow = utc_day_range()
+        today = datetime.date.fromisoformat(today_iso)
         
         # Basic counts
         total_habits = cur.execute("SELECT COUNT(*) as c FROM habits WHERE active=1").fetchone()[0]
         archived_habits = cur.execute("SELECT COUNT(*) as c FROM habits WHERE active=0").fetchone()[0]
 
-        # Completions over time periods
+        # Completions over time periods. Timestamps are ISO-8601 strings, so
+        # comparing them directly against a day lets SQLite use the
+        # timestamp indexes instead of calling date() on every row.
         seven_days_ago = (today - datetime.timedelta(days=6)).isoformat()
         thirty_days_ago = (today - datetime.timedelta(days=29)).isoformat()
 
         cur.execute("""
             SELECT COUNT(*) as c
             FROM habit_logs
-            WHERE event_type='complete' AND date(timestamp) >= ?
+            WHERE event_type='complete' AND timestamp >= ?
         """, (seven_days_ago,))
         completions_7d = cur.fetchone()[0]
 
         cur.execute("""
             SELECT COUNT(*) as c
             FROM habit_logs
-            WHERE event_type='complete' AND date(timestamp) = ?
-        """, (today.isoformat(),))
+            WHERE event_type='complete' AND timestamp >= ? AND timestamp < ?
+        """, (today_iso, tomorrow))
         completions_today = cur.fetchone()[0]
 
         cur.execute("""
             SELECT COUNT(*) as c
             FROM habit_logs
-            WHERE event_type='complete' AND date(timestamp) >= ?
+            WHERE event_type='complete' AND timestamp >= ?
         """, (thirty_days_ago,))
         completions_30d = cur.fetchone()[0]
 
@@ -500,7 +985,7 @@ def analytics_summary():
                 SUM(CASE WHEN event_type='complete' THEN 1 ELSE 0 END) as completes,
                 SUM(CASE WHEN event_type='skip' THEN 1 ELSE 0 END) as skips
             FROM habit_logs
-            WHERE date(timestamp) >= ?
+            WHERE timestamp >= ?
         """, (thirty_days_ago,))
         row = cur.fetchone()
         completes = row[0] or 0
@@ -510,76 +995,54 @@ def analytics_summary():
 
         # Daily breakdown (last 7 days)
         cur.execute("""
-            SELECT date(timestamp) as day, COUNT(*) as cnt
+            SELECT substr(timestamp, 1, 10) as day, COUNT(*) as cnt
             FROM habit_logs
-            WHERE event_type='complete' AND date(timestamp) >= ?
-            GROUP BY date(timestamp)
+            WHERE event_type='complete' AND timestamp >= ?
+            GROUP BY day
             ORDER BY day
         """, (seven_days_ago,))
         daily_breakdown = [{"day": r[0], "completions": r[1]} for r in cur.fetchall()]
 
-        # Top 5 habits by completions (30 days)
+        # Top 5 habits by completions (30 days), from the rolling counters
         cur.execute("""
-            SELECT h.id, h.name, COUNT(l.id) as cnt
+            SELECT h.id, h.name, COALESCE(r.completions, 0) as cnt
             FROM habits h
-            LEFT JOIN habit_logs l ON l.habit_id = h.id AND l.event_type='complete' AND date(l.timestamp) >= ?
+            LEFT JOIN habit_rolling_30d r ON r.habit_id = h.id
             WHERE h.active = 1
-            GROUP BY h.id
             ORDER BY cnt DESC
             LIMIT 5
-        """, (thirty_days_ago,))
+        """)
         top_habits = [{"id": r[0], "name": r[1], "completions": r[2]} for r in cur.fetchall()]
 
-        # Current streaks per habit
-        cur.execute("SELECT habit_id, day, completions FROM daily_agg ORDER BY habit_id, day")
-        rows = cur.fetchall()
-        
-        days_by_habit = defaultdict(list)
-        for r in rows:
-            if r["completions"] > 0:
-                days_by_habit[r["habit_id"]].append(r["day"])
-        
-        def calculate_current_streak(date_list):
-            """Calculate current streak ending today"""
-            if not date_list:
-                return 0
-            date_set = set(date_list)
-            current = today
-            streak = 0
-            while current.isoformat() in date_set:
-                streak += 1
-                current = current - datetime.timedelta(days=1)
-            return streak
-        
-        def longest_consecutive(date_list):
-            if not date_list:
-                return 0
-            s = set(date_list)
-            longest = 0
-            for d in date_list:
-                curd = datetime.date.fromisoformat(d)
-                length = 1
-                nxt = curd + datetime.timedelta(days=1)
-                while nxt.isoformat() in s:
-                    length += 1
-                    nxt = nxt + datetime.timedelta(days=1)
-                if length > longest:
-                    longest = length
-            return longest
-        
-        current_streaks = []
-        longest_streaks = []
-        for hid, ds in days_by_habit.items():
-            current_streaks.append(calculate_current_streak(ds))
-            longest_streaks.append(longest_consecutive(ds))
-        
+        # Streaks per habit (gaps and islands): within a run of consecutive
+        # days, julianday(day) - ROW_NUMBER() is constant, so each group is
+        # one streak. The current streak is the run that ends today.
+        cur.execute("""
+            WITH days AS (
+                SELECT habit_id, day,
+                       julianday(day) - ROW_NUMBER() OVER (PARTITION BY habit_id ORDER BY day) AS grp
+                FROM daily_agg
+                WHERE completions > 0
+            ), runs AS (
+                SELECT habit_id, COUNT(*) AS len, MAX(day) AS last_day
+                FROM days
+                GROUP BY habit_id, grp
+            )
+            SELECT habit_id,
+                   MAX(CASE WHEN last_day = ? THEN len ELSE 0 END) AS current_streak,
+                   MAX(len) AS longest_streak
+            FROM runs
+            GROUP BY habit_id
+        """, (today_iso,))
+        streak_rows = cur.fetchall()
+        current_streaks = [r["current_streak"] for r in streak_rows]
+        longest_streaks = [r["longest_streak"] for r in streak_rows]
+
         avg_current_streak = round(sum(current_streaks) / len(current_streaks), 1) if current_streaks else 0
         avg_longest_streak = int(sum(longest_streaks) / len(longest_streaks)) if longest_streaks else 0
         max_current_streak = max(current_streaks) if current_streaks else 0
-
-        conn.close()
         
-        return jsonify({
+        payload = {
             "status": "success",
             "data": {
                 "overview": {
@@ -603,7 +1066,12 @@ def analytics_summary():
                     "timezone": "UTC"
                 }
             }
-        }), 200
+        }
+        with _analytics_lock:
+            if gen == _analytics_cache["gen"]:
+                _analytics_cache.update(ts=time.monotonic(), payload=payload)
+
+        return jsonify(payload), 200
 
     except Exception as e:
         app.logger.exception("Analytics error")
@@ -613,8 +1081,23 @@ def analytics_summary():
             "error": str(e)
         }), 500
 
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    with _failures_lock:
+        failures = dict(write_failures)
+    # queued events are never written if the event writer thread has died
+    writer_alive = _writer_thread.is_alive()
+    return jsonify({
+        "status": "ok" if writer_alive else "error",
+        "event_writer_alive": writer_alive,
+        "write_queue": write_q.qsize(),
+        "write_failures": failures
+    }), 200 if writer_alive else 503
+
+
 # -----------------------------------
 # RUN
 # -----------------------------------
+# Development server only; deploy with gunicorn (settings in gunicorn.conf.py)
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    app.run(host="0.0.0.0", port=5000, debug=os.environ.get("FLASK_DEBUG") == "1", threaded=True)
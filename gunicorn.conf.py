@@ -0,0 +1,11 @@
+# Gunicorn settings, picked up automatically by `gunicorn app:app`.
+# Threaded workers let requests use WAL's concurrent readers; each worker keeps
+# a single writer connection and event writer thread of its own.
+bind = "0.0.0.0:5000"
+workers = 2
+worker_class = "gthread"
+threads = 8
+
+# app.py opens the writer connection and starts the event writer thread on
+# import, so every worker has to import it after forking.
+preload_app = False